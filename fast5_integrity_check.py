@@ -15,14 +15,14 @@ def main():
     if not fast5_files:
         sys.exit()
 
-    print('Checking file integrity', file=sys.stderr, end='')
+    print('Checking file integrity' + (' (thorough)' if args.thorough else ''), file=sys.stderr,
+          end='')
     good_fast5_count = 0
     bad_fast5_count = 0
     last_read_good = True
     for fast5_file in fast5_files:
         try:
-            hdf5_file = h5py.File(fast5_file, 'r')
-            get_hdf5_names(hdf5_file)
+            check_fast5(fast5_file, args.thorough)
             good_fast5_count += 1
             last_read_good = True
             if good_fast5_count % 100 == 0:
@@ -47,20 +47,47 @@ def get_arguments():
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('dir', type=str,
                         help='directory of FAST5 reads to check (will be searched recursively)')
+    parser.add_argument('--thorough', action='store_true',
+                        help='Visit every object in each FAST5 file, not just its root group '
+                             '(much slower but catches corruption deeper in the file)')
     args = parser.parse_args()
     args.dir = os.path.abspath(args.dir)
     return args
 
 
 def find_all_fast5s(directory):
+    """
+    Recursively searches the directory for FAST5 files. This uses os.scandir directly (instead of
+    os.walk) so each entry's type comes from the directory listing without an extra stat call.
+    Like os.walk, directories which can't be read are skipped.
+    """
     fast5s = []
-    for dir_name, _, filenames in os.walk(directory):
-        for filename in filenames:
-            if filename.endswith('.fast5'):
-                fast5s.append(os.path.join(dir_name, filename))
+    directories = [directory]
+    while directories:
+        try:
+            with os.scandir(directories.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    elif entry.name.endswith('.fast5'):
+                        fast5s.append(entry.path)
+        except OSError:
+            pass
     return fast5s
 
 
+def check_fast5(fast5_file, thorough):
+    """
+    Raises an exception if the FAST5 file can't be read. By default, only the root group is listed,
+    which catches files that are truncated or otherwise unreadable without a full traversal.
+    """
+    with h5py.File(fast5_file, 'r') as hdf5_file:
+        if thorough:
+            get_hdf5_names(hdf5_file)
+        else:
+            list(hdf5_file.keys())
+
+
 def get_hdf5_names(hdf5_file):
     names = []
     hdf5_file.visit(names.append)
@@ -2,10 +2,27 @@
 
 import os
 import argparse
+import concurrent.futures
+import functools
 import h5py
-import statistics
+import heapq
+import numpy as np
+import signal
 import sys
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# FAST5 files are sent to worker processes in batches of this size, with at most this many batches
+# per process in flight at once.
+BATCH_SIZE = 64
+BATCHES_PER_PROCESS = 4
+
+# Below this length, the built-in sum over the quality bytes is faster than making a NumPy array.
+SHORT_QUALS = 256
+
 
 def main():
     args = get_arguments()
@@ -25,53 +42,79 @@ def main():
         filters.append('min window quality >= ' + str(args.min_qual_window))
     message = 'Filtering reads based on: ' + ', '.join(filters)
     print(message, file=sys.stderr)
-    filtered_fast5_files = []
-    total_bases = 0
-    for fast5_file in fast5_files:
-        passes, length = check_filters(fast5_file, args.min_length, args.min_mean_qual,
-                                       args.min_qual_window, args.window_size)
-        if passes:
-            filtered_fast5_files.append(fast5_file)
-            total_bases += length
-    fast5_files = filtered_fast5_files
-    print('  ' + int_to_str(len(fast5_files)) + ' reads remain after filtering (' +
-          int_to_str(total_bases) + ' bp)\n', file=sys.stderr)
-    if not fast5_files:
-        sys.exit()
 
-    good_fast5_files = set()
-    if args.target_bases:
-        print('Automatically setting a minimum window quality threshold in order to reach a target '
-              'of ' + int_to_str(args.target_bases) + ' bp', file=sys.stderr)
-        if total_bases < args.target_bases:
-            print('  not enough total bases to reach target\n', file=sys.stderr)
+    # Without --target_bases, FASTQs are printed as soon as they come back from the workers, so
+    # they never pile up in memory. With --target_bases, they're kept until the best reads have
+    # been chosen. Once the cache is full, only the file is remembered and it will be opened again
+    # if its read is chosen.
+    if not args.target_bases:
+        print('Printing FASTQs to stdout', file=sys.stderr)
+    filtered_reads = []
+    filtered_count, total_bases = 0, 0
+    cache_left = args.max_cache * 1000000
+    worker = functools.partial(process_fast5, min_length=args.min_length,
+                               min_mean_qual=args.min_mean_qual,
+                               min_qual_window=args.min_qual_window,
+                               window_size=args.window_size, target_bases=args.target_bases)
+    for fast5_file, length, min_window_qual, fastq in \
+            process_in_parallel(worker, fast5_files, args.threads):
+        if fastq is None:
+            continue
+        filtered_count += 1
+        total_bases += length
+        if not args.target_bases:
+            sys.stdout.buffer.write(fastq)
         else:
-            min_window_quals_and_lengths = sorted([min_window_qual_and_length(f, args.window_size)
-                                                   for f in fast5_files], reverse=True)
-            total_bases = 0
-            min_window_qual_threshold = 0.0
-            for min_window_qual, length, fast5_file in min_window_quals_and_lengths:
-                total_bases += length
-                min_window_qual_threshold = min_window_qual
-                good_fast5_files.add(fast5_file)
-                if total_bases > args.target_bases:
-                    break
-            fast5_files = [f for f in fast5_files if f in good_fast5_files]
-            print('  min window quality threshold = ' + '%.2f' % min_window_qual_threshold,
-                  file=sys.stderr)
-            print('  ' + int_to_str(len(fast5_files)) + ' reads remain (' +
-                  int_to_str(total_bases) + ' bp)\n', file=sys.stderr)
+            if len(fastq) <= cache_left:
+                cache_left -= len(fastq)
+            else:
+                fastq = None
+            filtered_reads.append((min_window_qual, length, fast5_file, fastq))
+    print('  ' + int_to_str(filtered_count) + ' reads remain after filtering (' +
+          int_to_str(total_bases) + ' bp)', file=sys.stderr)
+    if not args.target_bases:
+        sys.stdout.flush()
+        print('  Done!\n', file=sys.stderr)
+        return
+    print('', file=sys.stderr)
+    if not filtered_reads:
+        sys.exit()
 
+    print('Automatically setting a minimum window quality threshold in order to reach a target '
+          'of ' + int_to_str(args.target_bases) + ' bp', file=sys.stderr)
+    if total_bases < args.target_bases:
+        print('  not enough total bases to reach target\n', file=sys.stderr)
+    else:
+        # Workers finish in an unpredictable order, so the reads are sorted by path to make
+        # get_best_reads break ties the same way on every run.
+        filtered_reads.sort(key=lambda read: read[2])
+        good_reads = []
+        total_bases = 0
+        min_window_qual_threshold = 0.0
+        for read in get_best_reads(filtered_reads, args.target_bases):
+            min_window_qual, length, _, _ = read
+            total_bases += length
+            min_window_qual_threshold = min_window_qual
+            good_reads.append(read)
+        filtered_reads = good_reads
+        print('  min window quality threshold = ' + '%.2f' % min_window_qual_threshold,
+              file=sys.stderr)
+        print('  ' + int_to_str(len(filtered_reads)) + ' reads remain (' +
+              int_to_str(total_bases) + ' bp)\n', file=sys.stderr)
+
+    # Cached FASTQs are printed first, then any that didn't fit in the cache are read again from
+    # their FAST5 files by the worker processes.
     print('Printing FASTQs to stdout', file=sys.stderr)
-    for fast5_file in fast5_files:
-        try:
-            hdf5_file = h5py.File(fast5_file, 'r')
-            names = get_hdf5_names(hdf5_file)
-            basecall_location = get_best_fastq_hdf5_location(hdf5_file, names)
-            if basecall_location:
-                print(hdf5_file[basecall_location].value.decode(), end='', flush=True)
-        except IOError:
-            pass
+    uncached_fast5_files = []
+    for _, _, fast5_file, fastq in filtered_reads:
+        if fastq is None:
+            uncached_fast5_files.append(fast5_file)
+        else:
+            sys.stdout.buffer.write(fastq)
+    for _, fastq in process_in_parallel(extract_fastq, uncached_fast5_files, args.threads):
+        if fastq:
+            sys.stdout.buffer.write(fastq)
+    sys.stdout.flush()
     print('  Done!\n', file=sys.stderr)
 
 
@@ -92,17 +135,39 @@ def get_arguments():
     parser.add_argument('--target_bases', type=int, default=None,
                         help='If set, exclude the worst reads (as judged by their minimum qscore '
                              'in a sliding window) such that only this many bases remain')
+    parser.add_argument('--max_cache', type=int, default=4000,
+                        help='When using --target_bases, hold at most this many megabytes of '
+                             'FASTQ in memory (reads beyond this are re-read from their FAST5 '
+                             'file if chosen)')
+    parser.add_argument('--threads', type=int, default=os.cpu_count() or 1,
+                        help='Number of processes used to read FAST5 files in parallel')
     args = parser.parse_args()
     args.dir = os.path.abspath(args.dir)
+    if args.threads < 1:
+        sys.exit('Error: --threads must be at least 1')
+    if args.target_bases is not None and args.target_bases < 1:
+        sys.exit('Error: --target_bases must be at least 1')
     return args
 
 
 def find_all_fast5s(directory):
+    """
+    Recursively searches the directory for FAST5 files. This uses os.scandir directly (instead of
+    os.walk) so each entry's type comes from the directory listing without an extra stat call.
+    Like os.walk, directories which can't be read are skipped.
+    """
     fast5s = []
-    for dir_name, _, filenames in os.walk(directory):
-        for filename in filenames:
-            if filename.endswith('.fast5'):
-                fast5s.append(os.path.join(dir_name, filename))
+    directories = [directory]
+    while directories:
+        try:
+            with os.scandir(directories.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    elif entry.name.endswith('.fast5'):
+                        fast5s.append(entry.path)
+        except OSError:
+            pass
     return fast5s
 
 
@@ -112,9 +177,47 @@ def get_hdf5_names(hdf5_file):
     return names
 
 
+def get_seq_and_quals(fastq):
+    """
+    Returns the sequence and quality lines of the FASTQ bytes as memoryviews, so they aren't
+    copied (the qualities go straight into NumPy) and nothing is decoded. Raises a ValueError if
+    the FASTQ doesn't have enough lines.
+    """
+    seq_start = fastq.index(b'\n') + 1
+    seq_end = fastq.index(b'\n', seq_start)
+    quals_start = fastq.index(b'\n', seq_end + 1) + 1
+    quals_end = fastq.find(b'\n', quals_start)
+    if quals_end == -1:
+        quals_end = len(fastq)
+    fastq_view = memoryview(fastq)
+    return fastq_view[seq_start:seq_end], fastq_view[quals_start:quals_end]
+
+
+def get_fastq_names(hdf5_file):
+    """
+    Returns the names of FASTQs in the FAST5 file. Basecallers store these at
+    Analyses/<basecall group>/<strand>/Fastq, so those locations are checked directly. Only if
+    none are found do we fall back to visiting every object in the file, which is much slower.
+    """
+    names = []
+    analyses = hdf5_file.get('Analyses')
+    if isinstance(analyses, h5py.Group):
+        for group_name, group in analyses.items():
+            if not isinstance(group, h5py.Group):
+                continue
+            for strand_name in group:
+                name = 'Analyses/' + group_name + '/' + strand_name + '/Fastq'
+                if name in hdf5_file:
+                    names.append(name)
+    return names if names else get_hdf5_names(hdf5_file)
+
+
 def get_mean_score(hdf5_file, basecall_location):
-    q = hdf5_file[basecall_location].value.split(b'\n')[3]
-    return statistics.mean([c - 33 for c in q])
+    try:
+        _, quals = get_seq_and_quals(hdf5_file[basecall_location][()])
+    except ValueError:
+        return 0.0
+    return get_mean_qscore(quals)
 
 
 def get_best_fastq_hdf5_location(hdf5_file, names):
@@ -162,73 +265,204 @@ def get_mean_qscore(quals):
     """
     Returns the mean qscore over the entire length of the qscore string.
     """
-    try:
-        return sum([q - 33 for q in quals]) / len(quals)
-    except ZeroDivisionError:
+    qual_count = len(quals)
+    if not qual_count:
         return 0.0
+    if qual_count < SHORT_QUALS:
+        qual_sum = sum(quals)
+    else:
+        qual_sum = int(np.frombuffer(quals, dtype=np.uint8).sum(dtype=np.int64))
+    return (qual_sum - 33 * qual_count) / qual_count
 
 
 def get_min_window_qscore(quals, window_size):
     """
     Returns the minimum mean qscore over a sliding window.
     """
-    quals = [q - 33 for q in quals]  # covert to numbers
-    current_window_qscore = statistics.mean(quals[:window_size])
-    shift_count = len(quals) - window_size
-    if shift_count < 1:
-        return current_window_qscore
-    min_window_qscore = current_window_qscore
-    for i in range(shift_count):
-        leaving_window = quals[i]
-        entering_window = quals[i + window_size]
-        current_window_qscore += (entering_window - leaving_window) / window_size
-        if current_window_qscore < min_window_qscore:
-            min_window_qscore = current_window_qscore
-    return min_window_qscore
-
-
-def check_filters(fast5_file, min_length, min_mean_qual, min_qual_window, window_size):
+    return get_mean_and_min_window_qscore(quals, window_size)[1]
+
+
+def get_mean_and_min_window_qscore(quals, window_size):
+    """
+    Returns both the mean qscore and the minimum mean qscore over a sliding window, using a
+    single pass over the qscore string.
+    """
+    if len(quals) <= window_size:
+        mean_qscore = get_mean_qscore(quals)
+        return mean_qscore, mean_qscore
+    qual_bytes = np.frombuffer(quals, dtype=np.uint8)
+    total, min_window_total = qual_sums(qual_bytes, window_size)
+    return float(total) / len(quals) - 33, float(min_window_total) / window_size - 33
+
+
+# The cumulative sums (row 0) and window sums (row 1) of qual_sums_numpy go in this array, which is
+# reused between reads and only replaced when a longer read comes along.
+qual_sums_buffer = None
+
+
+def qual_sums_numpy(qual_bytes, window_size):
+    """
+    Returns the sum of all quality bytes and the smallest sum of the quality bytes in any window,
+    using a cumulative sum.
+    """
+    global qual_sums_buffer
+    qual_count = len(qual_bytes)
+    if qual_sums_buffer is None or qual_sums_buffer.shape[1] <= qual_count:
+        qual_sums_buffer = np.empty((2, max(2 * qual_count, 65536)), dtype=np.int64)
+    cumulative_quals = qual_sums_buffer[0, :qual_count + 1]
+    cumulative_quals[0] = 0
+    np.cumsum(qual_bytes, dtype=np.int64, out=cumulative_quals[1:])
+    window_sums = qual_sums_buffer[1, :qual_count + 1 - window_size]
+    np.subtract(cumulative_quals[window_size:], cumulative_quals[:-window_size], out=window_sums)
+    return cumulative_quals[-1], window_sums.min()
+
+
+def qual_sums_loop(qual_bytes, window_size):
+    """
+    Returns the sum of all quality bytes and the smallest sum of the quality bytes in any window,
+    using a running sum. This is only fast when compiled with Numba, which avoids the temporary
+    arrays of the NumPy version.
+    """
+    window_sum = np.int64(0)
+    for i in range(window_size):
+        window_sum += qual_bytes[i]
+    total = window_sum
+    smallest_sum = window_sum
+    for i in range(window_size, len(qual_bytes)):
+        total += qual_bytes[i]
+        window_sum += qual_bytes[i]
+        window_sum -= qual_bytes[i - window_size]
+        if window_sum < smallest_sum:
+            smallest_sum = window_sum
+    return total, smallest_sum
+
+
+if njit is None:
+    qual_sums = qual_sums_numpy
+else:
+    qual_sums = njit(cache=True)(qual_sums_loop)
+
+
+def process_in_parallel(worker, fast5_files, threads):
+    """
+    Yields the worker's result for each FAST5 file, in the order they finish. While the main
+    process handles results (e.g. writing them to stdout), the worker processes keep reading
+    files. Batches are only submitted as earlier ones finish, so results can't pile up in memory if
+    the main process falls behind.
+    """
+    batches = (fast5_files[i:i + BATCH_SIZE] for i in range(0, len(fast5_files), BATCH_SIZE))
+    max_pending = threads * BATCHES_PER_PROCESS
+    pending = set()
+    with concurrent.futures.ProcessPoolExecutor(threads, initializer=init_worker) as executor:
+        for batch in batches:
+            pending.add(executor.submit(process_batch, worker, batch))
+            if len(pending) >= max_pending:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+        for future in concurrent.futures.as_completed(pending):
+            yield from future.result()
+
+
+def process_batch(worker, fast5_files):
+    return [worker(f) for f in fast5_files]
+
+
+def init_worker():
+    """
+    Worker processes ignore keyboard interrupts and leave them to the main process.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def check_filters(seq, quals, min_length, min_mean_qual, min_qual_window, window_size):
+    """
+    Checks the cheapest filters first. When both quality filters are used, they share a single
+    pass over the qscores. Returns whether the read passes and its min window qscore (None if it
+    wasn't needed), so the caller doesn't have to calculate it again.
+    """
+    if not seq:
+        return False, None
+    if min_length and len(seq) < min_length:
+        return False, None
+    if min_qual_window:
+        mean_qscore, min_window_qscore = get_mean_and_min_window_qscore(quals, window_size)
+        if min_mean_qual and mean_qscore < min_mean_qual:
+            return False, min_window_qscore
+        if min_window_qscore < min_qual_window:
+            return False, min_window_qscore
+        return True, min_window_qscore
+    if min_mean_qual and get_mean_qscore(quals) < min_mean_qual:
+        return False, None
+    return True, None
+
+
+def process_fast5(fast5_file, min_length, min_mean_qual, min_qual_window, window_size,
+                  target_bases):
+    """
+    Opens the FAST5 file once and returns its path, read length, min window qscore and FASTQ
+    bytes. The FASTQ is None if the file has no usable read or if the read fails the filters. The
+    min window qscore is only calculated when it's needed for --min_qual_window or
+    --target_bases, and then only once.
+    """
     try:
-        hdf5_file = h5py.File(fast5_file, 'r')
-        names = get_hdf5_names(hdf5_file)
-        basecall_location = get_best_fastq_hdf5_location(hdf5_file, names)
-        if basecall_location:
-            fastq_str = hdf5_file[basecall_location].value
+        fastq = get_fastq(fast5_file)
+        if fastq:
             try:
-                parts = fastq_str.split(b'\n')
-                seq, quals = parts[1], parts[3]
-            except IndexError:
-                fastq_str, seq, quals = '', '', ''
-            if not fastq_str or not seq:
-                return False, 0
-            if min_mean_qual and get_mean_qscore(quals) < min_mean_qual:
-                return False, 0
-            if min_length and len(seq) < min_length:
-                return False, 0
-            if min_qual_window and get_min_window_qscore(quals, window_size) < min_qual_window:
-                return False, 0
-            return True, len(seq)
+                seq, quals = get_seq_and_quals(fastq)
+            except ValueError:
+                return fast5_file, 0, 0.0, None
+            passes, min_window_qual = check_filters(seq, quals, min_length, min_mean_qual,
+                                                    min_qual_window, window_size)
+            if passes:
+                if not target_bases:
+                    min_window_qual = 0.0
+                elif min_window_qual is None:
+                    min_window_qual = get_min_window_qscore(quals, window_size)
+                return fast5_file, len(seq), min_window_qual, fastq
     except (IOError, RuntimeError):
         pass
-    return False, 0
+    return fast5_file, 0, 0.0, None
 
 
-def min_window_qual_and_length(fast5_file, window_size):
+def extract_fastq(fast5_file):
+    """
+    Returns the FAST5 file path and its best FASTQ as bytes (or None if it can't be read).
+    """
     try:
-        hdf5_file = h5py.File(fast5_file, 'r')
-        names = get_hdf5_names(hdf5_file)
-        basecall_location = get_best_fastq_hdf5_location(hdf5_file, names)
-        if basecall_location:
-            fastq_str = hdf5_file[basecall_location].value
-            try:
-                parts = fastq_str.split(b'\n')
-                seq, quals = parts[1], parts[3]
-                return get_min_window_qscore(quals, window_size), len(seq), fast5_file
-            except IndexError:
-                pass
+        return fast5_file, get_fastq(fast5_file)
     except (IOError, RuntimeError):
-        pass
-    return 0.0, 0, fast5_file
+        return fast5_file, None
+
+
+def get_fastq(fast5_file):
+    """
+    Returns the best FASTQ in the FAST5 file as bytes, or None if it doesn't have one.
+    """
+    hdf5_file = h5py.File(fast5_file, 'r')
+    names = get_fastq_names(hdf5_file)
+    basecall_location = get_best_fastq_hdf5_location(hdf5_file, names)
+    if basecall_location:
+        return hdf5_file[basecall_location][()]
+    return None
+
+
+def get_best_reads(reads, target_bases):
+    """
+    Yields reads from best to worst (by min window qscore, then length) until their total length
+    exceeds the target. Each read is a tuple starting with its min window qscore and length. Ties
+    go to the read later in the list, as they would in a reverse sort, so the choice only depends
+    on the order of the reads. The reads go in a heap instead of being fully sorted, so only the
+    reads which are used have to be put in order.
+    """
+    heap = [(-read[0], -read[1], -i) for i, read in enumerate(reads)]
+    heapq.heapify(heap)
+    total_bases = 0
+    while heap and total_bases <= target_bases:
+        read = reads[-heapq.heappop(heap)[2]]
+        total_bases += read[1]
+        yield read
 
 
 def int_to_str(num):
@@ -236,4 +470,10 @@ def int_to_str(num):
 
 
 if __name__ == '__main__':
-    main()
+    try:
+        main()
+    except BrokenPipeError:
+        # stdout was closed early (e.g. piped into head), so quietly stop. Pointing stdout at
+        # /dev/null stops Python complaining again when it flushes stdout on exit.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
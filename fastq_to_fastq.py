@@ -2,21 +2,27 @@
 
 import os
 import argparse
-import statistics
+import heapq
 import sys
 import gzip
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# Below this length, the built-in sum over the quality bytes is faster than making a NumPy array.
+SHORT_QUALS = 256
+
 
 def main():
     args = get_arguments()
 
-    print('\nLoading reads from: ' + args.input_fastq, file=sys.stderr)
-    input_reads = load_fastq(args.input_fastq)
-    print('  Found ' + int_to_str(len(input_reads)) + ' reads (' +
-          int_to_str(sum(len(seq) for _, seq, _ in input_reads)) + ' bp)\n', file=sys.stderr)
-    if not input_reads:
-        sys.exit()
-
     filters = []
     if args.min_length:
         filters.append('length >= ' + int_to_str(args.min_length) + ' bp')
@@ -24,55 +30,88 @@ def main():
         filters.append('mean quality >= ' + str(args.min_mean_qual))
     if args.min_qual_window:
         filters.append('min window quality >= ' + str(args.min_qual_window))
+    print('\nLoading reads from: ' + args.input_fastq, file=sys.stderr)
     message = 'Filtering reads based on: ' + ', '.join(filters)
     print(message, file=sys.stderr)
+
+    # Without --target_bases, reads which pass the filters are printed as they are loaded. With
+    # --target_bases, only the quality and length of each passing read is kept, and the file is
+    # read a second time to print the chosen reads.
+    if not args.target_bases:
+        print('Printing FASTQs to stdout', file=sys.stderr)
+    read_count, read_bases = 0, 0
     filtered_reads = []
-    total_bases = 0
-    for name, seq, quals in input_reads:
-        passes, length = check_filters(seq, quals, args.min_length, args.min_mean_qual,
-                                       args.min_qual_window, args.window_size)
-        if passes:
-            filtered_reads.append((name, seq, quals))
-            total_bases += length
-    print('  ' + int_to_str(len(filtered_reads)) + ' reads remain after filtering (' +
-          int_to_str(total_bases) + ' bp)\n', file=sys.stderr)
+    filtered_count, total_bases = 0, 0
+    for i, (name, seq, quals) in enumerate(iter_fastq(args.input_fastq)):
+        read_count += 1
+        read_bases += len(seq)
+        passes, length, min_window_qual = check_filters(seq, quals, args.min_length,
+                                                        args.min_mean_qual, args.min_qual_window,
+                                                        args.window_size)
+        if not passes:
+            continue
+        filtered_count += 1
+        total_bases += length
+        if not args.target_bases:
+            print_fastq(name, seq, quals)
+        else:
+            if min_window_qual is None:
+                min_window_qual = get_min_window_qscore(quals, args.window_size)
+            filtered_reads.append((min_window_qual, len(quals), i))
+    print('  Found ' + int_to_str(read_count) + ' reads (' + int_to_str(read_bases) + ' bp)',
+          file=sys.stderr)
+    print('  ' + int_to_str(filtered_count) + ' reads remain after filtering (' +
+          int_to_str(total_bases) + ' bp)', file=sys.stderr)
+    if not args.target_bases:
+        sys.stdout.flush()
+        print('  Done!\n', file=sys.stderr)
+        return
+    print('', file=sys.stderr)
     if not filtered_reads:
         sys.exit()
 
-    good_read_names = set()
-    if args.target_bases:
-        print('Automatically setting a minimum window quality threshold in order to reach a target '
-              'of ' + int_to_str(args.target_bases) + ' bp', file=sys.stderr)
-        if total_bases < args.target_bases:
-            print('  not enough total bases to reach target\n', file=sys.stderr)
-        else:
-            min_window_quals_and_lengths = \
-                sorted([min_window_qual_and_length(name, quals, args.window_size)
-                        for name, _, quals in filtered_reads], reverse=True)
-            total_bases = 0
-            min_window_qual_threshold = 0.0
-            for min_window_qual, length, read_name in min_window_quals_and_lengths:
-                total_bases += length
-                min_window_qual_threshold = min_window_qual
-                good_read_names.add(read_name)
-                if total_bases > args.target_bases:
-                    break
-            filtered_reads = [(name, seq, quals) for name, seq, quals in filtered_reads
-                              if name in good_read_names]
-            print('  min window quality threshold = ' + '%.2f' % min_window_qual_threshold,
-                  file=sys.stderr)
-            print('  ' + int_to_str(len(filtered_reads)) + ' reads remain (' +
-                  int_to_str(total_bases) + ' bp)\n', file=sys.stderr)
-
+    print('Automatically setting a minimum window quality threshold in order to reach a target '
+          'of ' + int_to_str(args.target_bases) + ' bp', file=sys.stderr)
+    if total_bases < args.target_bases:
+        print('  not enough total bases to reach target\n', file=sys.stderr)
+        good_read_indices = [i for _, _, i in filtered_reads]
+    else:
+        good_read_indices = []
+        total_bases = 0
+        min_window_qual_threshold = 0.0
+        for min_window_qual, length, read_index in \
+                get_best_reads(filtered_reads, args.target_bases):
+            total_bases += length
+            min_window_qual_threshold = min_window_qual
+            good_read_indices.append(read_index)
+        print('  min window quality threshold = ' + '%.2f' % min_window_qual_threshold,
+              file=sys.stderr)
+        print('  ' + int_to_str(len(good_read_indices)) + ' reads remain (' +
+              int_to_str(total_bases) + ' bp)\n', file=sys.stderr)
+
+    # The chosen reads are printed in file order by walking their sorted indices, which also lets
+    # us stop reading as soon as the last one has been printed.
     print('Printing FASTQs to stdout', file=sys.stderr)
-    for name, seq, quals in filtered_reads:
-        print('@' + name.decode())
-        print(seq.decode())
-        print('+')
-        print(quals.decode(), flush=True)
+    good_read_indices.sort()
+    next_good = 0
+    for i, (name, seq, quals) in enumerate(iter_fastq(args.input_fastq)):
+        if next_good == len(good_read_indices):
+            break
+        if i == good_read_indices[next_good]:
+            print_fastq(name, seq, quals)
+            next_good += 1
+    sys.stdout.flush()
     print('  Done!\n', file=sys.stderr)
 
 
+def print_fastq(name, seq, quals):
+    """
+    Writes the read to stdout as a single chunk of bytes. This doesn't flush, so the buffered
+    output is written in large blocks.
+    """
+    sys.stdout.buffer.write(b'@' + name + b'\n' + seq + b'\n+\n' + quals + b'\n')
+
+
 def get_arguments():
     parser = argparse.ArgumentParser(description='FASTQ filter tool',
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -102,80 +141,146 @@ def get_arguments():
                  '       FASTQ would be identical to the input FASTQ). Please use one of the\n'
                  '       following filters: --min_length, --min_mean_qual, --min_qual_window\n'
                  '       or --target_bases.')
+    if args.target_bases is not None and args.target_bases < 1:
+        sys.exit('Error: --target_bases must be at least 1')
     return args
 
 
-def find_all_fast5s(directory):
-    fast5s = []
-    for dir_name, _, filenames in os.walk(directory):
-        for filename in filenames:
-            if filename.endswith('.fast5'):
-                fast5s.append(os.path.join(dir_name, filename))
-    return fast5s
-
-
-def get_hdf5_names(hdf5_file):
-    names = []
-    hdf5_file.visit(names.append)
-    return names
-
-
-def get_mean_score(hdf5_file, basecall_location):
-    q = hdf5_file[basecall_location].value.split(b'\n')[3]
-    return statistics.mean([c - 33 for c in q])
-
-
 def get_mean_qscore(quals):
     """
     Returns the mean qscore over the entire length of the qscore string.
     """
-    try:
-        return sum([q - 33 for q in quals]) / len(quals)
-    except ZeroDivisionError:
+    qual_count = len(quals)
+    if not qual_count:
         return 0.0
+    if qual_count < SHORT_QUALS or np is None:
+        qual_sum = sum(quals)
+    else:
+        qual_sum = int(np.frombuffer(quals, dtype=np.uint8).sum(dtype=np.int64))
+    return (qual_sum - 33 * qual_count) / qual_count
 
 
 def get_min_window_qscore(quals, window_size):
     """
     Returns the minimum mean qscore over a sliding window.
     """
-    quals = [q - 33 for q in quals]  # covert to numbers
-    current_window_qscore = statistics.mean(quals[:window_size])
-    shift_count = len(quals) - window_size
-    if shift_count < 1:
-        return current_window_qscore
-    min_window_qscore = current_window_qscore
-    for i in range(shift_count):
-        leaving_window = quals[i]
-        entering_window = quals[i + window_size]
-        current_window_qscore += (entering_window - leaving_window) / window_size
-        if current_window_qscore < min_window_qscore:
-            min_window_qscore = current_window_qscore
-    return min_window_qscore
+    return get_mean_and_min_window_qscore(quals, window_size)[1]
+
+
+def get_mean_and_min_window_qscore(quals, window_size):
+    """
+    Returns both the mean qscore and the minimum mean qscore over a sliding window, using a
+    single pass over the qscore string.
+    """
+    if len(quals) <= window_size:
+        mean_qscore = get_mean_qscore(quals)
+        return mean_qscore, mean_qscore
+    if np is None:
+        qual_bytes = memoryview(quals)
+    else:
+        qual_bytes = np.frombuffer(quals, dtype=np.uint8)
+    total, min_window_total = qual_sums(qual_bytes, window_size)
+    return float(total) / len(quals) - 33, float(min_window_total) / window_size - 33
+
+
+# The cumulative sums (row 0) and window sums (row 1) of qual_sums_numpy go in this array, which is
+# reused between reads and only replaced when a longer read comes along.
+qual_sums_buffer = None
+
+
+def qual_sums_numpy(qual_bytes, window_size):
+    """
+    Returns the sum of all quality bytes and the smallest sum of the quality bytes in any window,
+    using a cumulative sum.
+    """
+    global qual_sums_buffer
+    qual_count = len(qual_bytes)
+    if qual_sums_buffer is None or qual_sums_buffer.shape[1] <= qual_count:
+        qual_sums_buffer = np.empty((2, max(2 * qual_count, 65536)), dtype=np.int64)
+    cumulative_quals = qual_sums_buffer[0, :qual_count + 1]
+    cumulative_quals[0] = 0
+    np.cumsum(qual_bytes, dtype=np.int64, out=cumulative_quals[1:])
+    window_sums = qual_sums_buffer[1, :qual_count + 1 - window_size]
+    np.subtract(cumulative_quals[window_size:], cumulative_quals[:-window_size], out=window_sums)
+    return cumulative_quals[-1], window_sums.min()
+
+
+def qual_sums_loop(qual_bytes, window_size):
+    """
+    Returns the sum of all quality bytes and the smallest sum of the quality bytes in any window,
+    using a running sum. This is fast when compiled with Numba, which avoids the temporary arrays
+    of the NumPy version. Without NumPy, it's also the pure Python fallback, run on a memoryview
+    of the quality bytes.
+    """
+    window_sum = 0
+    for i in range(window_size):
+        window_sum += qual_bytes[i]
+    total = window_sum
+    smallest_sum = window_sum
+    for i in range(window_size, len(qual_bytes)):
+        total += qual_bytes[i]
+        window_sum += qual_bytes[i]
+        window_sum -= qual_bytes[i - window_size]
+        if window_sum < smallest_sum:
+            smallest_sum = window_sum
+    return total, smallest_sum
+
+
+if njit is not None:
+    qual_sums = njit(cache=True)(qual_sums_loop)
+elif np is not None:
+    qual_sums = qual_sums_numpy
+else:
+    qual_sums = qual_sums_loop
 
 
 def check_filters(seq, quals, min_length, min_mean_qual, min_qual_window, window_size):
+    """
+    Checks the cheapest filters first. When both quality filters are used, they share a single
+    pass over the qscores. Returns whether the read passes, its length and its min window qscore
+    (None if it wasn't needed), so the caller doesn't have to calculate it again.
+    """
     if not seq:
-        return False, 0
-    if min_mean_qual and get_mean_qscore(quals) < min_mean_qual:
-        return False, 0
+        return False, 0, None
     if min_length and len(seq) < min_length:
-        return False, 0
-    if min_qual_window and get_min_window_qscore(quals, window_size) < min_qual_window:
-        return False, 0
-    return True, len(seq)
+        return False, 0, None
+    if min_qual_window:
+        mean_qscore, min_window_qscore = get_mean_and_min_window_qscore(quals, window_size)
+        if min_mean_qual and mean_qscore < min_mean_qual:
+            return False, 0, min_window_qscore
+        if min_window_qscore < min_qual_window:
+            return False, 0, min_window_qscore
+        return True, len(seq), min_window_qscore
+    if min_mean_qual and get_mean_qscore(quals) < min_mean_qual:
+        return False, 0, None
+    return True, len(seq), None
 
 
-def min_window_qual_and_length(name, quals, window_size):
-    return get_min_window_qscore(quals, window_size), len(quals), name
+def get_best_reads(reads, target_bases):
+    """
+    Yields reads from best to worst (by min window qscore, then length) until their total length
+    exceeds the target. Each read is a tuple starting with its min window qscore and length. Ties
+    go to the read later in the list, as they would in a reverse sort, so the choice only depends
+    on the order of the reads. The reads go in a heap instead of being fully sorted, so only the
+    reads which are used have to be put in order.
+    """
+    heap = [(-read[0], -read[1], -i) for i, read in enumerate(reads)]
+    heapq.heapify(heap)
+    total_bases = 0
+    while heap and total_bases <= target_bases:
+        read = reads[-heapq.heappop(heap)[2]]
+        total_bases += read[1]
+        yield read
 
 
 def int_to_str(num):
     return '{:,}'.format(num)
 
 
-def load_fastq(filename):
-    reads = []
+def iter_fastq(filename):
+    """
+    Yields the name, sequence and qualities of each read in the FASTQ, one at a time.
+    """
     if get_compression_type(filename) == 'gz':
         open_func = gzip.open
     else:  # plain text
@@ -192,8 +297,7 @@ def load_fastq(filename):
             sequence = next(fastq).strip()
             _ = next(fastq)
             qualities = next(fastq).strip()
-            reads.append((name, sequence, qualities))
-    return reads
+            yield name, sequence, qualities
 
 
 def get_compression_type(filename):